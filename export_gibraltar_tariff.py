@@ -2,57 +2,120 @@
 import os
 import csv
 import re
-import time
+import asyncio
 import argparse
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from lxml import etree, html as lxml_html
 
 BASE_URL = "https://www.hmcustoms.gov.gi/portal/services/tariff/print.jsf?c={chapter}"
 
-# Match full Gibraltar-style codes
+# Match full Gibraltar-style codes. The leading lookahead lets the engine
+# reject non-code positions on the first character instead of entering the
+# counted repetition before failing.
 CODE_PATTERN = re.compile(
-    r"\b[0-9*]{10}-[0-9*]{2}-[0-9*]{2}\b"
+    r"\b(?=[0-9*])[0-9*]{10}-[0-9*]{2}-[0-9*]{2}\b"
 )
 
 
-def fetch_chapter_text(chapter: int) -> str:
-    """Fetch raw text for a chapter from the Gibraltar HM Customs tariff."""
+# Column order for the record tuples written to each CSV
+HIERARCHY_FIELDS = [
+    "chapter",
+    "heading",
+    "heading_description",
+    "subheading",
+    "subheading_description",
+    "code",
+    "description",
+]
+CHAPTER_FIELDS = ["chapter", "chapter_title"]
+
+# Cap in-flight requests so we don't hammer the server now that fetches overlap.
+MAX_CONCURRENT_FETCHES = 8
+
+# Retry transient failures with exponential backoff (mirrors urllib3's
+# Retry(total=3, backoff_factor=0.3, status_forcelist=...)).
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+async def fetch_chapter_html(
+    session: aiohttp.ClientSession, chapter: int, cache_dir: str = None
+) -> bytes:
+    """Fetch raw HTML for a chapter from the Gibraltar HM Customs tariff.
+
+    If cache_dir is given, raw chapter HTML is read from / written to it so
+    repeat runs (e.g. while iterating locally) skip the network entirely.
+    """
     chapter_str = f"{chapter:02d}"
     url = BASE_URL.format(chapter=chapter_str)
 
-    resp = requests.get(
-        url,
-        timeout=30,
-        headers={"User-Agent": "gib-tariff-scraper/1.0"},
-    )
-    resp.raise_for_status()
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"chapter_{chapter_str}.html")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return f.read()
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    text = soup.get_text("\n", strip=True)
-    return text
+    body = await _download_chapter(session, url)
+    if cache_path:
+        with open(cache_path, "wb") as f:
+            f.write(body)
+    return body
 
 
-def extract_chapter_name(text: str, chapter: int) -> str:
-    """Extract the chapter title"""
-    chapter_str = f"{chapter:02d}"
-    for line in text.splitlines():
-        line = line.strip()
-        if line.startswith("CHAPTER ") and chapter_str in line:
-            return line.strip()
-    return ""
+async def _download_chapter(session: aiohttp.ClientSession, url: str) -> bytes:
+    """Download one chapter page, retrying transient failures with backoff."""
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            async with session.get(
+                url,
+                timeout=aiohttp.ClientTimeout(total=30),
+                headers={
+                    "User-Agent": "gib-tariff-scraper/1.0",
+                    # Ask for compressed bodies explicitly; aiohttp decodes
+                    # transparently (br needs the brotli package).
+                    "Accept-Encoding": "gzip, deflate, br",
+                },
+            ) as resp:
+                resp.raise_for_status()
+                return await resp.read()
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == RETRY_TOTAL:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
 
 
-def extract_hierarchy_from_text(text: str, chapter: int) -> List[Dict[str, str]]:
+def extract_hierarchy_from_text(
+    text: str, chapter: int
+) -> Tuple[str, List[Tuple[str, ...]]]:
     """
-    Extract complete hierarchy with descriptions for each level:
+    Extract the chapter title and the complete hierarchy with descriptions
+    for each level:
     chapter → heading (with description) → subheading (with description) → code (with description)
+
+    The walk below visits every line anyway, so the title (e.g.
+    "CHAPTER 01 - LIVE ANIMALS") is picked up in the same pass rather than
+    rescanning the text separately.
+
+    Returns (chapter_title, records), with records as (chapter, heading,
+    heading_description, subheading, subheading_description, code,
+    description) tuples matching HIERARCHY_FIELDS.
     """
     records = []
     seen = set()
+    chapter_name = ""
+    title_prefix = f"CHAPTER {chapter:02d}"
     
-    lines = text.splitlines()
+    # Strip each line exactly once; the walk below re-reads lines for
+    # lookahead, so stripping lazily would repeat the work.
+    lines = [line.strip() for line in text.splitlines()]
     chapter_str = f"{chapter:02d}"
     
     current_heading = ""
@@ -62,14 +125,16 @@ def extract_hierarchy_from_text(text: str, chapter: int) -> List[Dict[str, str]]
     
     i = 0
     while i < len(lines):
-        line = lines[i].strip()
-        
+        line = lines[i]
+
         if not line:
             i += 1
             continue
         
-        # Skip chapter title and headers
+        # Capture the chapter title, then skip it and the column headers
         if line.startswith("CHAPTER ") or line in ["Chapter", "Heading", "Article Description"]:
+            if not chapter_name and line.startswith(title_prefix):
+                chapter_name = line
             i += 1
             continue
         
@@ -82,7 +147,7 @@ def extract_hierarchy_from_text(text: str, chapter: int) -> List[Dict[str, str]]
             
             # Get heading description from next line if available
             if i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
+                next_line = lines[i + 1]
                 if next_line and not next_line.isdigit() and not CODE_PATTERN.match(next_line):
                     current_heading_desc = next_line
                     i += 1
@@ -97,14 +162,18 @@ def extract_hierarchy_from_text(text: str, chapter: int) -> List[Dict[str, str]]
             
             # Get subheading description from next line if available
             if i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
+                next_line = lines[i + 1]
                 if next_line and not next_line.isdigit() and not CODE_PATTERN.match(next_line):
                     current_subheading_desc = next_line
                     i += 1
             i += 1
             continue
         
-        # Check for tariff codes
+        # Check for tariff codes; every code contains "-", so a C-level
+        # substring test prescreens most lines before the regex runs.
+        if "-" not in line:
+            i += 1
+            continue
         for match in CODE_PATTERN.finditer(line):
             code = match.group(0)
             
@@ -113,29 +182,68 @@ def extract_hierarchy_from_text(text: str, chapter: int) -> List[Dict[str, str]]
             desc = desc.lstrip(" -–—:")
             
             if not desc and i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
+                next_line = lines[i + 1]
                 if next_line and not CODE_PATTERN.match(next_line):
                     desc = next_line
             
-            key = (chapter_str, current_heading, current_heading_desc, 
-                   current_subheading, current_subheading_desc, code, desc)
-            if key in seen:
+            record = (chapter_str, current_heading, current_heading_desc,
+                      current_subheading, current_subheading_desc, code, desc)
+            if record in seen:
                 continue
-            seen.add(key)
-            
-            records.append({
-                "chapter": chapter_str,
-                "heading": current_heading,
-                "heading_description": current_heading_desc,
-                "subheading": current_subheading,
-                "subheading_description": current_subheading_desc,
-                "code": code,
-                "description": desc,
-            })
+            seen.add(record)
+            records.append(record)
         
         i += 1
-    
-    return records
+
+    return chapter_name, records
+
+
+def parse_chapter(job: Tuple[int, bytes]) -> Tuple[str, List[Tuple[str, ...]]]:
+    """Parse one chapter's HTML into its title and hierarchy records.
+
+    Takes a (chapter, html_bytes) pair so it can be dispatched to a
+    ProcessPoolExecutor worker; parsing is the CPU-bound half of the job and
+    scales across cores this way.
+    """
+    chapter, body = job
+    # lxml raises ParserError on an empty document; treat an empty or
+    # whitespace-only body (e.g. a truncated cache file) as a chapter with
+    # no content, as the bs4 version did.
+    if not body.strip():
+        return "", []
+
+    # Feed raw bytes to lxml (C parser) and let it sniff the encoding; this
+    # skips a redundant decode pass. Drop script/style subtrees first — unlike
+    # bs4's get_text, itertext would include their contents, and a code-shaped
+    # string inside a script would corrupt the extraction. With those gone,
+    # itertext matches bs4's get_text("\n", strip=True) at a fraction of the
+    # cost, walking the tree in C without building wrapper objects.
+    root = lxml_html.fromstring(body)
+    etree.strip_elements(root, "script", "style", with_tail=False)
+    text = "\n".join(s.strip() for s in root.itertext() if s.strip())
+
+    return extract_hierarchy_from_text(text, chapter)
+
+
+async def fetch_all_chapters(
+    chapters: List[int], cache_dir: str = None
+) -> List[object]:
+    """Fetch all chapter pages concurrently, bounded by a semaphore.
+
+    Returns one entry per chapter, in order: either the raw HTML bytes or the
+    exception raised while fetching it.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+    async def fetch_one(session: aiohttp.ClientSession, chapter: int) -> bytes:
+        async with sem:
+            print(f"Fetching chapter {chapter:02d}...")
+            return await fetch_chapter_html(session, chapter, cache_dir)
+
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_FETCHES)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [fetch_one(session, chapter) for chapter in chapters]
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def main():
@@ -154,49 +262,21 @@ def main():
         help="Output CSV file path for chapter names "
              "(default: gibraltar_chapters.csv)",
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for cached chapter HTML; when set, re-runs reuse "
+             "downloaded pages instead of refetching (default: disabled)",
+    )
     args = parser.parse_args()
 
-    all_records: List[Dict[str, str]] = []
-    chapter_records: List[Dict[str, str]] = []
-
-    for chapter in range(1, 100):  # 01..99 inclusive
-        print(f"Fetching chapter {chapter:02d}...")
-        try:
-            text = fetch_chapter_text(chapter)
-        except requests.HTTPError as e:
-            print(f"  !! HTTP error for chapter {chapter:02d}: {e}")
-            continue
-        except requests.RequestException as e:
-            print(f"  !! Request error for chapter {chapter:02d}: {e}")
-            continue
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
 
-        # Extract chapter name
-        chapter_name = extract_chapter_name(text, chapter)
-        chapter_records.append({
-            "chapter": f"{chapter:02d}",
-            "chapter_title": chapter_name,
-        })
-
-        # Extract complete hierarchy
-        hierarchy_records = extract_hierarchy_from_text(text, chapter)
-        print(f"  -> found {len(hierarchy_records)} codes")
-        all_records.extend(hierarchy_records)
-
-        time.sleep(0.3)
-
-    # Global dedupe
-    final_seen = set()
-    deduped_records = []
-    for rec in all_records:
-        key = (rec["chapter"], rec["heading"], rec["heading_description"], 
-               rec["subheading"], rec["subheading_description"], 
-               rec["code"], rec["description"])
-        if key in final_seen:
-            continue
-        final_seen.add(key)
-        deduped_records.append(rec)
+    chapters = list(range(1, 100))  # 01..99 inclusive
 
-    print(f"Total codes collected: {len(deduped_records)}")
+    # Stage 1: fetch all chapter HTML concurrently (I/O-bound).
+    results = asyncio.run(fetch_all_chapters(chapters, args.cache_dir))
 
     # Ensure output directories exist
     for path in (args.hierarchy_outfile, args.chapters_outfile):
@@ -204,31 +284,52 @@ def main():
         if out_dir:
             os.makedirs(out_dir, exist_ok=True)
 
-    # Write hierarchy CSV
-    with open(args.hierarchy_outfile, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f, 
-            fieldnames=[
-                "chapter", 
-                "heading", 
-                "heading_description",
-                "subheading", 
-                "subheading_description",
-                "code", 
-                "description"
-            ]
-        )
-        writer.writeheader()
-        writer.writerows(deduped_records)
+    # Stage 2: parse the fetched chapters across worker processes (CPU-bound),
+    # writing each chapter's rows as its result is consumed so records are
+    # never all held in memory at once and a crash mid-run still leaves
+    # partial output. A failed chapter is reported and skipped, like a failed
+    # fetch, without aborting the run. Per-chapter dedupe in
+    # extract_hierarchy_from_text is sufficient, since every record key
+    # includes the chapter number.
+    total_codes = 0
+    with ProcessPoolExecutor() as executor, \
+         open(args.hierarchy_outfile, "w", newline="", encoding="utf-8") as hier_f, \
+         open(args.chapters_outfile, "w", newline="", encoding="utf-8") as chap_f:
+        hier_writer = csv.writer(hier_f)
+        hier_writer.writerow(HIERARCHY_FIELDS)
+        chap_writer = csv.writer(chap_f)
+        chap_writer.writerow(CHAPTER_FIELDS)
 
-    print(f"Wrote hierarchy CSV to {args.hierarchy_outfile}")
+        futures = {
+            chapter: executor.submit(parse_chapter, (chapter, body))
+            for chapter, body in zip(chapters, results)
+            if not isinstance(body, BaseException)
+        }
 
-    # Write chapters CSV
-    with open(args.chapters_outfile, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["chapter", "chapter_title"])
-        writer.writeheader()
-        writer.writerows(chapter_records)
+        for chapter, body in zip(chapters, results):
+            chapter_str = f"{chapter:02d}"
+            if isinstance(body, aiohttp.ClientResponseError):
+                print(f"  !! HTTP error for chapter {chapter_str}: {body}")
+                continue
+            if isinstance(body, (aiohttp.ClientError, asyncio.TimeoutError)):
+                print(f"  !! Request error for chapter {chapter_str}: {body}")
+                continue
+            if isinstance(body, BaseException):
+                raise body
+
+            try:
+                chapter_name, hierarchy_records = futures.pop(chapter).result()
+            except Exception as e:
+                print(f"  !! Parse error for chapter {chapter_str}: {e}")
+                continue
 
+            chap_writer.writerow((chapter_str, chapter_name))
+            print(f"  -> found {len(hierarchy_records)} codes")
+            hier_writer.writerows(hierarchy_records)
+            total_codes += len(hierarchy_records)
+
+    print(f"Total codes collected: {total_codes}")
+    print(f"Wrote hierarchy CSV to {args.hierarchy_outfile}")
     print(f"Wrote chapters CSV to {args.chapters_outfile}")
 
 